@@ -11,47 +11,83 @@ import os
 import re
 import time
 import serial
+import struct
 import binascii
+import itertools
 import argparse
 import configparser
 import platform
 from typing import Union
 
+_HEADER_RE = re.compile(b"^#![Rr][Pp]6502(\r|)\n$")
+_DATA_RE = re.compile("^ *([^ ]+) *([^ ]+) *([^ ]+) *$")
+_ADDRESS_RE = re.compile("^(0x|)[0-9A-Fa-f]*$")
+_U16 = struct.Struct("<H")
+_U16X2 = struct.Struct("<HH")
+_TAG = f"[{os.path.basename(__file__)}]"
+
+
+def str_to_address(string):
+    """Supports $FFFF number format. Raises ValueError."""
+    if string.startswith("$"):
+        string = "0x" + string[1:]
+    if _ADDRESS_RE.match(string):
+        try:
+            if string.startswith("0x"):
+                return int(string[2:], 16)
+            return int(string, 10)
+        except ValueError:
+            pass
+    raise ValueError(f"invalid address: '{string}'")
+
 
 class Monitor:
     """Manages the monitor application on the serial console."""
 
     DEFAULT_TIMEOUT = 0.5
+    # Stop-and-wait by default. Deeper pipelines have not yet been
+    # tested on hardware against the RIA's receive buffering.
+    PIPELINE_DEPTH = 1
+    UPLOAD_CHUNK_SIZE = 1024
     UART_BAUDRATE = 115200
+    WRITE_TIMEOUT = 5.0
+    BUFFER_SIZE = 0x10000
 
     def __init__(self, name, timeout=DEFAULT_TIMEOUT):
         self.serial = serial.Serial()
         self.serial.setPort(name)
         self.serial.timeout = timeout
         self.serial.baudrate = self.UART_BAUDRATE
+        self.serial.write_timeout = self.WRITE_TIMEOUT
         self.serial.open()
+        if platform.system() == "Windows":
+            # Let the driver absorb whole BINARY and UPLOAD bursts.
+            self.serial.set_buffer_size(
+                rx_size=self.BUFFER_SIZE, tx_size=self.BUFFER_SIZE
+            )
+        self.rx_buffer = bytearray()
 
     def send_break(self, duration=0.01, retries=1):
         """Stop the 6502 and return to monitor."""
-        self.serial.read_all()
-        if platform.system() == "Darwin":
-            self.serial.baudrate = 1200
-            self.serial.write(b"\0")
-            self.serial.baudrate = self.UART_BAUDRATE
-        else:
-            self.serial.send_break(duration)
-        try:
-            self.wait_for_prompt("]")
-            return
-        except TimeoutError as te:
-            if retries <= 0:
-                raise te
-        self.send_break(duration, retries - 1)
+        for attempt in range(retries + 1):
+            self.serial.read_all()
+            self.rx_buffer.clear()
+            if platform.system() == "Darwin":
+                self.serial.baudrate = 1200
+                self.serial.write(b"\0")
+                self.serial.baudrate = self.UART_BAUDRATE
+            else:
+                self.serial.send_break(duration)
+            try:
+                self.wait_for_prompt("]")
+                return
+            except TimeoutError:
+                if attempt >= retries:
+                    raise
 
     def command(self, str, timeout=DEFAULT_TIMEOUT):
         """Send one command and wait for next monitor prompt"""
-        self.serial.write(bytes(str, "ascii"))
-        self.serial.write(b"\r")
+        self.serial.write(bytes(str + "\r", "ascii"))
         self.wait_for_prompt("]", timeout)
 
     def reset(self):
@@ -59,162 +95,212 @@ class Monitor:
         self.serial.write(b"RESET\r")
         self.serial.read_until()
 
-    def binary(self, addr: int, data):
+    def binary(self, addr: int, data, crc: Union[int, None] = None):
         """Send data to memory using BINARY command."""
-        command = f"BINARY ${addr:04X} ${len(data):03X} ${binascii.crc32(data):08X}\r"
-        self.serial.write(bytes(command, "utf-8"))
-        self.serial.write(data)
-        self.wait_for_prompt("]")
+        self.binary_pipelined([(addr, data, crc)], 1)
+
+    def binary_pipelined(self, chunks, depth=PIPELINE_DEPTH):
+        """Send (addr, data, crc) chunks using BINARY commands."""
+        """Up to depth commands are written before waiting for prompts."""
+        if depth < 1:
+            raise ValueError(f"Invalid pipeline depth: {depth}")
 
-    def upload(self, file, name):
+        def packets():
+            """Yields (command count, bytes to write) per batch."""
+            chunk_iter = iter(chunks)
+            while True:
+                packet = []
+                for addr, data, crc in itertools.islice(chunk_iter, depth):
+                    if crc == None:
+                        crc = binascii.crc32(data)
+                    command = f"BINARY ${addr:04X} ${len(data):03X} ${crc:08X}\r"
+                    packet.append(bytes(command, "ascii"))
+                    packet.append(data)
+                if len(packet) == 0:
+                    return
+                yield len(packet) // 2, b"".join(packet)
+
+        self.send_ahead(packets(), "]")
+
+    def upload(self, file, name, chunk_size=UPLOAD_CHUNK_SIZE):
         """Upload readable file to remote file "name" """
+        if chunk_size < 1 or chunk_size > self.UPLOAD_CHUNK_SIZE:
+            raise ValueError(f"Invalid upload chunk size: {chunk_size}")
         self.serial.write(bytes(f"UPLOAD {name}\r", "ascii"))
         self.wait_for_prompt("}")
         file.seek(0)
-        while True:
-            chunk = file.read(1024)
-            if len(chunk) == 0:
-                break
-            command = f"${len(chunk):03X} ${binascii.crc32(chunk):08X}\r"
-            self.serial.write(bytes(command, "ascii"))
-            self.serial.write(chunk)
-            self.wait_for_prompt("}")
+        data = memoryview(file.read())
+
+        def packets():
+            """Yields (command count, bytes to write) per chunk."""
+            for offset in range(0, len(data), chunk_size):
+                chunk = data[offset : offset + chunk_size]
+                command = f"${len(chunk):03X} ${binascii.crc32(chunk):08X}\r"
+                yield 1, b"".join((bytes(command, "ascii"), chunk))
+
+        self.send_ahead(packets(), "}")
         self.serial.write(b"END\r")
         self.wait_for_prompt("]")
 
-    def send_rom(self, rom):
+    def send_ahead(self, packets, prompt):
+        """Write each packet then wait for its prompts. The next packet"""
+        """is built, CRCs included, while the RIA processes this one."""
+        packets = iter(packets)
+        packet = next(packets, None)
+        while packet != None:
+            count, data = packet
+            self.serial.write(data)
+            packet = next(packets, None)
+            for i in range(count):
+                self.wait_for_prompt(prompt)
+
+    def send_rom(self, rom, depth=PIPELINE_DEPTH):
         """Send rom."""
-        addr, data = rom.next_rom_data(0)
-        while data != None:
-            self.binary(addr, data)
-            addr += len(data)
-            addr, data = rom.next_rom_data(addr)
+        chunks = (
+            (addr, data, binascii.crc32(data)) for addr, data in rom.iter_rom_blocks()
+        )
+        self.binary_pipelined(chunks, depth)
 
     def wait_for_prompt(self, prompt, timeout=DEFAULT_TIMEOUT):
-        """Wait for prompt."""
+        """Wait for prompt. Input past the prompt is kept for the next wait."""
+        """Times out after timeout seconds with no input."""
         prompt = bytes(prompt, "ascii")
+        buffer = self.rx_buffer
+        scanned = 0
         start = time.monotonic()
         while True:
-            if len(prompt) == 1:
-                data = self.serial.read()
-            else:
-                data = self.serial.read_until()
-            if data[0:1] == b"?":
-                monitor_result = data.decode("ascii")
-                monitor_result += self.serial.read_until().decode("ascii").strip()
+            found = buffer.find(prompt, scanned)
+            error = buffer.find(b"?", scanned, None if found < 0 else found)
+            if error >= 0:
+                line_end = buffer.find(b"\n", error)
+                if line_end < 0:
+                    buffer += self.serial.read_until()
+                    line_end = len(buffer)
+                monitor_result = buffer[error:line_end].decode("ascii").strip()
+                del buffer[: line_end + 1]
                 raise RuntimeError(monitor_result)
-            if data == prompt:
-                break
+            if found >= 0:
+                del buffer[: found + len(prompt)]
+                return
+            scanned = max(0, len(buffer) - len(prompt) + 1)
+            # Take everything the driver has, or block for the next byte.
+            data = self.serial.read(max(1, self.serial.in_waiting))
             if len(data) == 0:
                 if time.monotonic() - start > timeout:
                     raise TimeoutError()
+            else:
+                # Timeout is for silence, not for the whole response.
+                start = time.monotonic()
+            buffer += data
 
 
 class ROM:
     """Virtual ROM aka The RP6502 ROM."""
 
+    MAX_HELP_LINES = 24
+    MAX_HELP_WIDTH = 80
+
     def __init__(self):
         """ROMs begin with up to a screen of help text"""
         """ followed by a sparse array of virtual ROM. """
         self.help = []
-        self.data = [0 for i in range(0x20000)]
-        self.alloc = [0 for i in range(0x20000)]
+        self.data = bytearray(0x20000)
+        self.alloc = bytearray(0x20000)
 
     def add_help(self, string):
         """Add help string."""
-        if len(string) > 80:
+        if len(self.help) >= self.MAX_HELP_LINES:
+            raise RuntimeError(f"Help lines > {self.MAX_HELP_LINES}")
+        if len(string) > self.MAX_HELP_WIDTH:
             raise RuntimeError("Help line too long")
         self.help.append(string)
-        if len(self.help) > 24:
-            raise RuntimeError("Help lines > 24")
 
     def add_binary_data(self, data, addr: int):
         """Add binary data."""
-        offset = 0
         length = len(data)
         self.allocate_rom(addr, length)
-        for i in range(length):
-            self.data[addr + i] = data[offset + i]
+        self.data[addr : addr + length] = data
 
     def add_irq_vector(self, addr: int):
         """Set IRQ vector in $FFFE and $FFFF."""
-        if addr < 0 or addr > 0xFFFF:
-            raise RuntimeError(f"Invalid IRQ vector: ${addr:04X}")
-        self.allocate_rom(0xFFFE, 2)
-        self.data[0xFFFE] = addr & 0xFF
-        self.data[0xFFFF] = addr >> 8
+        self._set_vector(0xFFFE, addr, "IRQ")
 
     def add_nmi_vector(self, addr: int):
         """Set NMI vector in $FFFA and $FFFB."""
-        if addr < 0 or addr > 0xFFFF:
-            raise RuntimeError(f"Invalid NMI vector: ${addr:04X}")
-        self.allocate_rom(0xFFFA, 2)
-        self.data[0xFFFA] = addr & 0xFF
-        self.data[0xFFFB] = addr >> 8
+        self._set_vector(0xFFFA, addr, "NMI")
 
     def add_reset_vector(self, addr: int):
         """Set reset vector in $FFFC and $FFFD."""
+        self._set_vector(0xFFFC, addr, "reset")
+
+    def _set_vector(self, slot: int, addr: int, name: str):
+        """Store a little-endian 6502 vector at slot."""
         if addr < 0 or addr > 0xFFFF:
-            raise RuntimeError(f"Invalid reset vector: ${addr:04X}")
-        self.allocate_rom(0xFFFC, 2)
-        self.data[0xFFFC] = addr & 0xFF
-        self.data[0xFFFD] = addr >> 8
+            raise RuntimeError(f"Invalid {name} vector: ${addr:04X}")
+        self.allocate_rom(slot, 2)
+        _U16.pack_into(self.data, slot, addr)
 
     def add_binary_file(self, file, addr: Union[int, None] = None):
         """Add binary memory data from file. addr=None uses"""
         """first two bytes as address and second two bytes as reset."""
         with open(file, "rb") as f:
             data = f.read()
+        offset = 0
         if addr == None:
             if len(data) < 4:
                 raise RuntimeError("No addresses found.")
-            addr = data[0] + data[1] * 256
-            self.add_reset_vector(data[2] + data[3] * 256)
-            data = data[4:]
-        self.add_binary_data(data, addr)
+            addr, reset = _U16X2.unpack_from(data)
+            self.add_reset_vector(reset)
+            offset = 4
+        self.add_binary_data(memoryview(data)[offset:], addr)
 
     def add_rp6502_file(self, file):
         """Add RP6502 ROM data from file."""
         with open(file, "rb") as f:
-            # Decode first line as cp850 because binary garbage can
-            # raise here before our better message gets to the user.
-            command = f.readline().decode("cp850")
-            if not re.match("^#![Rr][Pp]6502(\r|)\n$", command):
-                raise RuntimeError(f"Invalid RP6502 ROM file: {file}")
-            while True:
-                command = f.readline().decode("ascii").rstrip()
-                if len(command) == 0:
-                    break
-                se = re.search("^ *(# )", command)
-                if se:
-                    self.add_help(command[se.start(1) + 2 :])
-                    continue
-                if re.search("^ *#$", command):
-                    self.add_help("")
-                    continue
-                se = re.search("^ *([^ ]+) *([^ ]+) *([^ ]+) *$", command)
-                if se:
-
-                    def str_to_address(str):
-                        """Supports $FFFF number format."""
-                        if str:
-                            str = re.sub("^\\$", "0x", str)
-                        if re.match("^(0x|)[0-9A-Fa-f]*$", str):
-                            return eval(str)
-                        else:
-                            raise RuntimeError(f"Invalid address: {str}")
-
+            rom = f.read()
+        view = memoryview(rom)
+
+        def readline(pos):
+            """Returns the line at pos like f.readline() and the next pos."""
+            end = rom.find(b"\n", pos)
+            end = len(rom) if end < 0 else end + 1
+            return rom[pos:end], end
+
+        # Match the first line as bytes because binary garbage can
+        # raise on decode before our better message gets to the user.
+        command, pos = readline(0)
+        if not _HEADER_RE.match(command):
+            raise RuntimeError(f"Invalid RP6502 ROM file: {file}")
+        while True:
+            command, pos = readline(pos)
+            command = command.decode("ascii").rstrip()
+            if len(command) == 0:
+                break
+            help = command.lstrip(" ")
+            if help.startswith("# "):
+                self.add_help(help[2:])
+                continue
+            if help == "#":
+                self.add_help("")
+                continue
+            se = _DATA_RE.search(command)
+            if se:
+                try:
                     addr = str_to_address(se.group(1))
                     length = str_to_address(se.group(2))
                     crc = str_to_address(se.group(3))
-                    self.allocate_rom(addr, length)
-                    data = f.read(length)
-                    if len(data) != length or crc != binascii.crc32(data):
-                        raise RuntimeError(f"Invalid CRC in block address: ${addr:04X}")
-                    for i in range(length):
-                        self.data[addr + i] = data[i]
-                    continue
-                raise RuntimeError(f"Corrupt RP6502 ROM file: {file}")
+                except ValueError as ve:
+                    raise RuntimeError(
+                        f"Invalid address in RP6502 ROM file: {file}"
+                    ) from ve
+                self.allocate_rom(addr, length)
+                data = view[pos : pos + length]
+                pos += len(data)
+                if len(data) != length or crc != binascii.crc32(data):
+                    raise RuntimeError(f"Invalid CRC in block address: ${addr:04X}")
+                self.data[addr : addr + length] = data
+                continue
+            raise RuntimeError(f"Corrupt RP6502 ROM file: {file}")
 
     def allocate_rom(self, addr, length):
         """Marks a range of memory as used. Raises on error."""
@@ -225,28 +311,34 @@ class ROM:
             or length < 0
         ):
             raise IndexError(
-                f"RP6502 invalid address ${addr+i:04X} or length ${length+i:03X}"
+                f"RP6502 invalid address ${addr:04X} or length ${length:03X}"
             )
-        for i in range(length):
-            if self.alloc[addr + i]:
-                raise MemoryError(f"RP6502 ROM data already exists at ${addr+i:04X}")
-            self.alloc[addr + i] = 1
+        used = self.alloc.find(1, addr, addr + length)
+        if used >= 0:
+            raise MemoryError(f"RP6502 ROM data already exists at ${used:04X}")
+        self.alloc[addr : addr + length] = b"\x01" * length
 
     def has_reset_vector(self):
         """Returns true if $FFFC and $FFFD have been set."""
         return self.alloc[0xFFFC] and self.alloc[0xFFFD]
 
     def next_rom_data(self, addr: int):
-        """Find next up-to-1k chunk starting at addr."""
-        for addr in range(addr, 0x20000):
-            if self.alloc[addr]:
-                length = 0
-                while self.alloc[addr + length]:
-                    length += 1
-                    if length == 1024 or addr + length == 0x10000:
-                        break
-                return addr, bytearray(self.data[addr : addr + length])
-        return None, None
+        """Find next up-to-1k chunk starting at addr. Returns a read-only view."""
+        addr = self.alloc.find(1, addr)
+        if addr < 0:
+            return None, None
+        limit = min(addr + 1024, 0x10000 if addr < 0x10000 else 0x20000)
+        end = self.alloc.find(0, addr, limit)
+        if end < 0:
+            end = limit
+        return addr, memoryview(self.data)[addr:end].toreadonly()
+
+    def iter_rom_blocks(self):
+        """Yields (addr, data) for every up-to-1k chunk in address order."""
+        addr, data = self.next_rom_data(0)
+        while data != None:
+            yield addr, data
+            addr, data = self.next_rom_data(addr + len(data))
 
 
 def exec_args():
@@ -316,28 +408,27 @@ def exec_args():
             args.device = config["RP6502"].get("device", args.device)
 
     # Additional validation and conversion
-    def str_to_address(parser, str, errmsg):
+    def arg_to_address(parser, str, errmsg):
         """Supports $FFFF number format."""
         if str:
-            str = re.sub("^\\$", "0x", str)
-            if re.match("^(0x|)[0-9A-Fa-f]*$", str):
-                return eval(str)
-            else:
-                parser.error(f"argument {errmsg}: invalid address: '{str}'")
+            try:
+                return str_to_address(str)
+            except ValueError as ve:
+                parser.error(f"argument {errmsg}: {ve}")
 
-    args.address = str_to_address(parser, args.address, "-a/--address")
-    args.irq = str_to_address(parser, args.irq, "-i/--irq")
-    args.nmi = str_to_address(parser, args.nmi, "-n/--nmi")
-    args.reset = str_to_address(parser, args.reset, "-r/--reset")
+    args.address = arg_to_address(parser, args.address, "-a/--address")
+    args.irq = arg_to_address(parser, args.irq, "-i/--irq")
+    args.nmi = arg_to_address(parser, args.nmi, "-n/--nmi")
+    args.reset = arg_to_address(parser, args.reset, "-r/--reset")
 
     # python3 tools/rp6502.py run
     if args.command == "run":
-        print(f"[{os.path.basename(__file__)}] Loading ROM {args.filename[0]}")
+        print(f"{_TAG} Loading ROM {args.filename[0]}")
         rom = ROM()
         rom.add_rp6502_file(args.filename[0])
         if args.reset != None:
             rom.add_reset_vector(args.reset)
-        print(f"[{os.path.basename(__file__)}] Opening device {args.device}")
+        print(f"{_TAG} Opening device {args.device}")
         mon = Monitor(args.device)
         mon.send_break()
         mon.send_rom(rom)
@@ -348,12 +439,12 @@ def exec_args():
 
     # python3 tools/rp6502.py upload
     if args.command == "upload":
-        print(f"[{os.path.basename(__file__)}] Opening device {args.device}")
+        print(f"{_TAG} Opening device {args.device}")
         mon = Monitor(args.device)
         if len(args.filename) > 0:
             mon.send_break()
         for file in args.filename:
-            print(f"[{os.path.basename(__file__)}] Uploading {file}")
+            print(f"{_TAG} Uploading {file}")
             with open(file, "rb") as f:
                 if len(args.filename) == 1 and args.out != None:
                     dest = args.out
@@ -363,7 +454,7 @@ def exec_args():
 
     # python3 tools/rp6502.py create
     if args.command == "create":
-        print(f"[{os.path.basename(__file__)}] Creating {args.out}")
+        print(f"{_TAG} Creating {args.out}")
         rom = ROM()
         if args.irq != None:
             rom.add_irq_vector(args.irq)
@@ -371,26 +462,20 @@ def exec_args():
             rom.add_nmi_vector(args.nmi)
         if args.reset != None:
             rom.add_reset_vector(args.reset)
-        print(f"[{os.path.basename(__file__)}] Adding Binary Asset {args.filename[0]}")
+        print(f"{_TAG} Adding Binary Asset {args.filename[0]}")
         rom.add_binary_file(args.filename[0], args.address)
         for file in args.filename[1:]:
-            print(f"[{os.path.basename(__file__)}] Adding ROM Asset {file}")
+            print(f"{_TAG} Adding ROM Asset {file}")
             rom.add_rp6502_file(file)
+        # Assemble the whole ROM file so it goes out in one write.
+        output = [b"#!RP6502\n"]
+        output.append(b"".join(bytes(f"# {help}\n", "ascii") for help in rom.help))
+        for addr, data in rom.iter_rom_blocks():
+            crc = binascii.crc32(data)
+            output.append(bytes(f"${addr:04X} ${len(data):03X} ${crc:08X}\n", "ascii"))
+            output.append(data)
         with open(args.out, "wb+") as file:
-            file.write(b"#!RP6502\n")
-            for help in rom.help:
-                file.write(bytes(f"# {help}\n", "ascii"))
-            addr, data = rom.next_rom_data(0)
-            while data != None:
-                file.write(
-                    bytes(
-                        f"${addr:04X} ${len(data):03X} ${binascii.crc32(data):08X}\n",
-                        "ascii",
-                    )
-                )
-                file.write(data)
-                addr += len(data)
-                addr, data = rom.next_rom_data(addr)
+            file.write(b"".join(output))
 
 
 # This file may be included or run like a program. e.g.